@@ -52,21 +52,25 @@ def run():
         demo0 = net.netns_add(name="demo0")
         demo1 = net.netns_add(name="demo1")
 
-        net.link_veth_add(p1_name="demo0-eth0", p2_name="demo1-eth0")
-
-        # Move the interfaces to the namespaces
-        net.link_set(namespace="demo0", interface="demo0-eth0")
-        net.link_set(namespace="demo1", interface="demo1-eth0")
-
-        # Bind an IP-address to the two peers in the link.
-        demo0.addr_add(ip="10.0.0.1/24", interface="demo0-eth0")
-        demo1.addr_add(ip="10.0.0.2/24", interface="demo1-eth0")
-
-        # Activate the interfaces.
-        demo0.up(interface="demo0-eth0")
-        demo1.up(interface="demo1-eth0")
-        demo0.up(interface="lo")
-        demo1.up(interface="lo")
+        # Configure the link in a batch. Only consecutive commands for the same
+        # namespace run together, so they are grouped: one 'ip -batch' for the
+        # host and one for each namespace.
+        with net.batch():
+            net.link_veth_add(p1_name="demo0-eth0", p2_name="demo1-eth0")
+
+            # Move the interfaces to the namespaces
+            net.link_set(namespace="demo0", interface="demo0-eth0")
+            net.link_set(namespace="demo1", interface="demo1-eth0")
+
+            # Bind an IP-address to the two peers in the link and activate the
+            # interfaces.
+            demo0.addr_add(ip="10.0.0.1/24", interface="demo0-eth0")
+            demo0.up(interface="demo0-eth0")
+            demo0.up(interface="lo")
+
+            demo1.addr_add(ip="10.0.0.2/24", interface="demo1-eth0")
+            demo1.up(interface="demo1-eth0")
+            demo1.up(interface="lo")
 
         # Test will run until last non-daemon process is done.
         proc0 = demo0.run_async(cmd="ping -c 20 10.0.0.2", daemon=True)
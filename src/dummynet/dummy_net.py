@@ -1,10 +1,114 @@
+import contextlib
+import itertools
+import json
 import re
+import shlex
+
 from subprocess import CalledProcessError
+from . import errors
 from . import namespace_shell
 from dummynet.cgroups import CGroup
 from logging import Logger
 
 
+def _parse_json(output):
+    """Parses the output of 'ip -json'.
+
+    :param output: The output as a string
+    :return: The parsed list, empty if there was no output
+    """
+
+    # Some versions of 'ip' print nothing rather than '[]'
+    if not output.strip():
+        return []
+
+    return json.loads(output)
+
+
+def _run_tool(shell, tool, command, cwd=None):
+    """Runs a command, retrying with the tool in /usr/sbin if not found.
+
+    The PATH inside a namespace, or of sudo, may not include /usr/sbin
+    where tools like 'tc' are installed.
+
+    :param shell: The shell to run the command in
+    :param tool: The name of the tool, e.g. 'tc'
+    :param command: Function returning the command given the tool to use
+    :param cwd: The working directory to run the command in
+    :return: A :ref:`dummynetruninfo` object
+    """
+
+    try:
+        return shell.run(cmd=command(tool), cwd=cwd)
+    except errors.RunInfoError as e:
+        stderr = e.info.stderr or ""
+
+        # The errors of 'ip netns exec', dash and bash respectively
+        not_found = (
+            f'exec of "{tool}" failed',
+            f"{tool}: not found",
+            f"{tool}: command not found",
+        )
+
+        if not any(message in stderr for message in not_found):
+            raise
+
+    return shell.run(cmd=command(f"/usr/sbin/{tool}"), cwd=cwd)
+
+
+def _batch_command(lines):
+    """Returns a function building the command to run lines with a tool.
+
+    :param lines: The arguments for each invocation of the tool
+    """
+
+    if len(lines) == 1:
+        return lambda tool: f"{tool} {lines[0]}"
+
+    quoted = " ".join(shlex.quote(line) for line in lines)
+
+    def command(tool):
+        # The commands are piped to the tool by a shell, as the stdin of the
+        # command carries the sudo password. This also puts the commands in
+        # the logged command, and in the error if one fails.
+        script = f"printf '%s\\n' {quoted} | {tool} -batch -"
+
+        # Double quotes keep the single quoted lines readable in logs
+        script = re.sub(r'([\\"$`])', r"\\\1", script)
+
+        return f'sh -c "{script}"'
+
+    return command
+
+
+class _Batch:
+    """Commands queued by :meth:`DummyNet.batch` to run together.
+
+    A batch is shared by a DummyNet and the namespaces it creates, such
+    that commands keep their order across namespaces.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.commands = []
+
+    def flush(self):
+        """Run the queued commands.
+
+        Consecutive commands for the same shell and tool are passed to a
+        single invocation of the tool using its '-batch' option.
+        """
+
+        commands, self.commands = self.commands, []
+
+        groups = itertools.groupby(commands, key=lambda c: (c[0], c[1]))
+
+        for (shell, tool), group in groups:
+            lines = [args for _, _, args in group]
+
+            _run_tool(shell=shell, tool=tool, command=_batch_command(lines))
+
+
 class DummyNet(object):
     """A DummyNet object is used to create a network of virtual ethernet
     devices and bind them to namespaces.
@@ -19,6 +123,92 @@ class DummyNet(object):
         self.cgroups = []
         self.cleaners = []
 
+        # Commands queued while batching, see batch()
+        self._batch = _Batch()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Runs the 'ip' and 'tc' commands issued inside the context together.
+
+        Commands such as :meth:`link_set`, :meth:`addr_add`, :meth:`up` and
+        :meth:`tc` are queued and run when the context exits, using a single
+        'ip -batch' or 'tc -batch' invocation for each run of consecutive
+        commands in the same namespace. This saves starting a process (and
+        sudo) per command. The batch also covers the namespaces created by
+        this object.
+
+        Commands that produce output, like :meth:`netns_list` or :meth:`run`,
+        are not queued; they first run the commands queued so far.
+
+        Example::
+
+            with net.batch():
+                net.link_set(namespace="demo0", interface="demo0-eth0")
+                demo0.addr_add(ip="10.0.0.1/24", interface="demo0-eth0")
+                demo0.up(interface="demo0-eth0")
+
+        If an exception is raised inside the context, the queued commands
+        are discarded.
+        """
+
+        if self._batch.active:
+            # Nested batches run with the outermost one
+            yield
+            return
+
+        self._batch.active = True
+
+        try:
+            yield
+        except BaseException:
+            self._batch.commands = []
+            raise
+        finally:
+            self._batch.active = False
+
+        self._batch.flush()
+
+    def _ip(self, args):
+        """Runs an 'ip' command, or queues it if a batch is active.
+
+        :param args: The arguments to 'ip'
+        """
+
+        if self._batch.active:
+            self._batch.commands.append((self.shell, "ip", args))
+        else:
+            self._run(cmd=f"ip {args}")
+
+    def _tc(self, args, cwd=None):
+        """Runs a 'tc' command, or queues it if a batch is active.
+
+        :param args: The arguments to 'tc'
+        :param cwd: The working directory to run the command in. Queued
+            commands run together, so cwd does not apply to them.
+        """
+
+        if self._batch.active:
+            self._batch.commands.append((self.shell, "tc", args))
+            return
+
+        self._batch.flush()
+
+        _run_tool(
+            shell=self.shell, tool="tc", command=lambda tool: f"{tool} {args}", cwd=cwd
+        )
+
+    def _run(self, cmd, cwd=None):
+        """Runs a command after any commands queued by a batch.
+
+        :param cmd: The command to run
+        :param cwd: The working directory to run the command in
+        :return: A :ref:`dummynetruninfo` object
+        """
+
+        self._batch.flush()
+
+        return self.shell.run(cmd=cmd, cwd=cwd)
+
     def link_veth_add(self, p1_name, p2_name):
         """Adds a virtual ethernet between two endpoints.
 
@@ -29,9 +219,7 @@ class DummyNet(object):
         :param p2_name: Name of the second endpoint
         """
 
-        self.shell.run(
-            cmd=f"ip link add {p1_name} type veth peer name {p2_name}", cwd=None
-        )
+        self._ip(f"link add {p1_name} type veth peer name {p2_name}")
 
     def link_set(self, namespace, interface):
         """Binds a network interface (usually the veths) to a namespace.
@@ -42,7 +230,7 @@ class DummyNet(object):
         :param interface: The interface to bind to the namespace
         """
 
-        self.shell.run(cmd=f"ip link set {interface} netns {namespace}", cwd=None)
+        self._ip(f"link set {interface} netns {namespace}")
 
     def link_list(self, link_type=None):
         """Returns the output of the 'ip link list' command parsed to a
@@ -52,57 +240,36 @@ class DummyNet(object):
         :return: A list of strings with the names of the links
         """
 
-        cmd = "ip link list"
+        cmd = "ip -json link list"
 
         if link_type != None:
             cmd += f" type {link_type}"
 
-        output = self.shell.run(cmd=cmd, cwd=None)
-
-        parser = re.compile(
-            """
-            \d+             # Match one or more digits
-            :               # Followed by a colon
-            \s              # Followed by a space
-            (?P<name>[^:@]+)# Match all but : or @ (group "name")
-            [:@]            # Followed by : or @
-            .               # Followed by anything :)
-        """,
-            re.VERBOSE,
-        )
-
-        names = []
-
-        for line in output.splitlines():
-            # The name is the first word followed by a space
-            result = parser.match(line)
+        output = self._run(cmd=cmd)
 
-            if result == None:
-                continue
-
-            names.append(result.group("name"))
+        names = [link["ifname"] for link in _parse_json(output.stdout)]
 
         return sorted(names)
 
     def link_delete(self, interface):
         """Deletes a specific network interface."""
 
-        self.shell.run(cmd=f"ip link delete {interface}", cwd=None)
+        self._ip(f"link delete {interface}")
 
     def addr_add(self, ip, interface):
         """Adds an IP-address to a network interface."""
 
-        self.shell.run(f"ip addr add {ip} dev {interface}", cwd=None)
+        self._ip(f"addr add {ip} dev {interface}")
 
     def up(self, interface):
         """Sets the given network interface to 'up'"""
 
-        self.shell.run(f"ip link set dev {interface} up", cwd=None)
+        self._ip(f"link set dev {interface} up")
 
     def route(self, ip):
         """Sets a new default IP-route."""
 
-        self.shell.run(f"ip route add default via {ip}", cwd=None)
+        self._ip(f"route add default via {ip}")
 
     def run(self, cmd, cwd=None):
         """Wrapper for the command-line access
@@ -112,7 +279,7 @@ class DummyNet(object):
         :return: A :ref:`dummynetruninfo` object
         """
 
-        return self.shell.run(cmd=cmd, cwd=cwd)
+        return self._run(cmd=cmd, cwd=cwd)
 
     def run_async(self, cmd, daemon=False, cwd=None):
         """Wrapper for the concurrent command-line access
@@ -126,6 +293,8 @@ class DummyNet(object):
         :return: A :ref:`dummynetruninfo` object
         """
 
+        self._batch.flush()
+
         return self.shell.run_async(cmd=cmd, daemon=daemon, cwd=cwd)
 
     def tc_show(self, interface, cwd=None):
@@ -133,11 +302,11 @@ class DummyNet(object):
         interface"""
 
         try:
-            output = self.shell.run(cmd=f"tc qdisc show dev {interface}", cwd=cwd)
+            output = self._run(cmd=f"tc qdisc show dev {interface}", cwd=cwd)
         except CalledProcessError as e:
             if e.stderr == 'exec of "tc" failed: No such file or directory\n':
                 try:
-                    output = self.shell.run(
+                    output = self._run(
                         cmd=f"/usr/sbin/tc qdisc show dev {interface}", cwd=cwd
                     )
 
@@ -150,58 +319,40 @@ class DummyNet(object):
 
     def tc(self, interface, delay=None, loss=None, rate=None, limit=None, cwd=None):
         """Modifies the given interface by adding any artificial combination of
-        delay, packet loss, bandwidth constraints or queue limits"""
+        delay, packet loss, bandwidth constraints or queue limits
 
-        extra_command = ""
-
-        output = self.tc_show(interface=interface, cwd=cwd)
-
-        if "netem" in output.stdout:
-            action = "change"
-
-        else:
-            action = "add"
+        Inside :meth:`batch` the command is queued, and cwd does not apply.
+        """
 
-        cmd = f"tc qdisc {action} dev {interface} root netem"
+        # 'replace' adds the qdisc, or changes it if already there
+        args = f"qdisc replace dev {interface} root netem"
         if delay:
-            cmd += f" delay {delay}ms"
+            args += f" delay {delay}ms"
         if loss:
-            cmd += f" loss {loss}%"
+            args += f" loss {loss}%"
         if rate:
-            cmd += f" rate {rate}Mbit"
+            args += f" rate {rate}Mbit"
         if limit:
-            cmd += f" limit {limit}"
+            args += f" limit {limit}"
 
-        try:
-            self.shell.run(cmd=cmd, cwd=cwd)
-        except CalledProcessError as e:
-            if e.stderr == 'exec of "tc" failed: No such file or directory\n':
-                try:
-                    extra_command += "/usr/sbin/"
-                    self.shell.run(cmd=extra_command + cmd, cwd=cwd)
-
-                except CalledProcessError:
-                    raise
-            else:
-                raise
+        self._tc(args, cwd=cwd)
 
     def forward(self, from_interface, to_interface):
         """Forwards all traffic from one network interface to another."""
-        self.shell.run(
-            f"iptables -A FORWARD -o {from_interface} -i {to_interface} -j ACCEPT",
-            cwd=None,
+        self._run(
+            cmd=f"iptables -A FORWARD -o {from_interface} -i {to_interface} -j ACCEPT"
         )
 
     def nat(self, ip, interface):
         extra_command = ""
         cmd = f"iptables -t nat -A POSTROUTING -s {ip} -o {interface} -j MASQUERADE"
         try:
-            self.shell.run(cmd=cmd, cwd=None)
+            self._run(cmd=cmd)
         except CalledProcessError as e:
             if e.stderr == 'exec of "iptables" failed: No such file or directory\n':
                 try:
                     extra_command += "/usr/sbin/"
-                    self.shell.run(cmd=extra_command + cmd, cwd=None)
+                    self._run(cmd=extra_command + cmd)
 
                 except CalledProcessError:
                     raise
@@ -209,26 +360,24 @@ class DummyNet(object):
                 raise
 
     def netns_list(self):
-        """Returns a list of all network namespaces. Runs 'ip netns list'"""
+        """Returns a sorted list of all network namespaces. Runs
+        'ip netns list'
+        """
 
-        result = self.shell.run(cmd="ip netns list", cwd=None)
-        names = []
+        result = self._run(cmd="ip -json netns list")
 
-        for line in result.stdout.splitlines():
-            # The name is the first word followed by a space
-            name = line.split(" ")[0]
-            names.append(name)
+        names = [netns["name"] for netns in _parse_json(result.stdout)]
 
         return sorted(names)
 
     def netns_process_list(self, name):
         """Returns a list of all processes in a network namespace"""
-        result = self.shell.run(cmd=f"ip netns pids {name}", cwd=None)
+        result = self._run(cmd=f"ip netns pids {name}")
         return result.stdout.splitlines()
 
     def netns_kill_process(self, name, pid):
         """Kills a process in a network namespace"""
-        self.shell.run(cmd=f"ip netns exec {name} kill -9 {pid}", cwd=None)
+        self._run(cmd=f"ip netns exec {name} kill -9 {pid}")
 
     def netns_kill_all(self, name):
         """Kills all processes running in a network namespace"""
@@ -252,7 +401,7 @@ class DummyNet(object):
         :param name: Name of the namespace to delete
         """
 
-        self.shell.run(cmd=f"ip netns delete {name}", cwd=None)
+        self._run(cmd=f"ip netns delete {name}")
 
     def netns_add(self, name):
         """Adds a new network namespace.
@@ -263,11 +412,15 @@ class DummyNet(object):
         Configuring these namespaces with the other utility commands allows you
         to configure the networks."""
 
-        self.shell.run(cmd=f"ip netns add {name}", cwd=None)
+        self._run(cmd=f"ip netns add {name}")
         shell = namespace_shell.NamespaceShell(name=name, shell=self.shell)
 
         dnet = DummyNet(shell=shell)
 
+        # Share the batch, so commands queued in the namespace keep their
+        # order relative to ours
+        dnet._batch = self._batch
+
         # Store cleanup function to remove the created namespace
         def cleaner():
             self.netns_kill_all(name=name)
@@ -280,7 +433,7 @@ class DummyNet(object):
 
     def bridge_add(self, name):
         """Adds a bridge"""
-        self.shell.run(cmd=f"ip link add name {name} type bridge", cwd=None)
+        self._ip(f"link add name {name} type bridge")
 
     def bridge_up(self, name):
         """Brings a bridge up"""
@@ -288,7 +441,7 @@ class DummyNet(object):
 
     def bridge_set(self, name, interface):
         """Adds an interface to a bridge"""
-        self.shell.run(cmd=f"ip link set {interface} master {name}", cwd=None)
+        self._ip(f"link set {interface} master {name}")
 
     def bridge_list(self):
         """List the different bridges"""
@@ -1,10 +1,4 @@
-import subprocess
 import os
-import time
-import getpass
-
-from . import run_info
-from . import errors
 
 
 class HostShell(object):
@@ -3,6 +3,9 @@ class NamespaceShell:
         self.name = name
         self.shell = shell
 
+        # Every command is run inside the namespace
+        self.cmd_prefix = f"ip netns exec {name} "
+
     @property
     def process_monitor(self):
         return self.shell.process_monitor
@@ -16,7 +19,7 @@ class NamespaceShell:
         """
 
         return self.shell.run(
-            cmd=f"ip netns exec {self.name} {cmd}", cwd=cwd, env=env, timeout=timeout
+            cmd=self.cmd_prefix + cmd, cwd=cwd, env=env, timeout=timeout
         )
 
     def run_async(self, cmd, daemon=False, cwd=None):
@@ -26,6 +29,4 @@ class NamespaceShell:
             run
         """
 
-        return self.shell.run_async(
-            cmd=f"ip netns exec {self.name} {cmd}", daemon=daemon, cwd=cwd
-        )
+        return self.shell.run_async(cmd=self.cmd_prefix + cmd, daemon=daemon, cwd=cwd)
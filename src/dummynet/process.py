@@ -1,9 +1,3 @@
-import textwrap
-
-from . import run_info
-from . import errors
-
-
 class Process(object):
     """Process object to track the state of a process
 
@@ -1,15 +1,14 @@
 import select
-import textwrap
 import os
 import subprocess
 import signal
 import getpass
+import time
 
 from functools import lru_cache
 from typing import Optional
 
 from . import errors
-from . import process
 from . import run_info
 
 # The cached sudo password
@@ -62,6 +61,25 @@ def update_sudo_password():
     cached_sudo_password = getpass.getpass(prompt=prompt) + "\n"
 
 
+def pidfd_open(pid: int) -> Optional[int]:
+    """Open a file descriptor referring to a process.
+
+    The file descriptor becomes readable when the process exits, which
+    allows us to wait for process exit using the poller.
+
+    :param pid: The process ID
+    :return: The file descriptor or None if not supported by the platform
+             (requires Linux 5.3 or later)
+    """
+    if not hasattr(os, "pidfd_open"):
+        return None
+
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        return None
+
+
 class ProcessMonitor:
     """
     The basic idea behind the monitor is to coordinate a process execution.
@@ -79,15 +97,22 @@ class ProcessMonitor:
 
     class Poller:
         def __init__(self, log):
-            self.poller = select.poll()
+            # The epoll instance keeps the registered file descriptors in
+            # the kernel, so they are not passed on every call to poll
+            self.poller = select.epoll()
             self.callbacks = {}
+            self.exit_callbacks = {}
             self.log = log
 
         def add_fd(self, fd, callback):
-            # Note that flags POLLHUP and POLLERR can be returned at any time
-            # (even if were not asked for). So we don't need to explicitly
-            # register for them.
-            self.poller.register(fd, select.POLLIN)
+            # Note that flags EPOLLHUP and EPOLLERR can be returned at any
+            # time (even if were not asked for). So we don't need to
+            # explicitly register for them.
+            self.poller.register(fd, select.EPOLLIN)
+
+            # Reads must not block when the pipe has been drained, see
+            # read_fd()
+            os.set_blocking(fd, False)
 
             self.callbacks[fd] = callback
 
@@ -99,25 +124,68 @@ class ProcessMonitor:
 
             self.log.debug(f"Poller: unregister process fd {fd}")
 
+        def add_pidfd(self, pidfd, callback):
+            # A pidfd becomes readable when the process exits
+            self.poller.register(pidfd, select.EPOLLIN)
+
+            self.exit_callbacks[pidfd] = callback
+
+            self.log.debug(f"Poller: register pidfd {pidfd}")
+
+        def del_pidfd(self, pidfd):
+            self.poller.unregister(pidfd)
+            del self.exit_callbacks[pidfd]
+            os.close(pidfd)
+
+            self.log.debug(f"Poller: unregister pidfd {pidfd}")
+
         def read_fd(self, fd):
-            data = b""
+            chunks = []
             while True:
-                chunk = os.read(fd, 4096)  # Read in chunks of 4096 bytes
-                data += chunk
-                if len(chunk) < 4096:
-                    # If we read less than 4096 bytes, we are done
+                try:
+                    chunk = os.read(fd, 65536)
+                except BlockingIOError:
+                    # The pipe has been drained
+                    break
+
+                if not chunk:
+                    # The process closed its end of the pipe
                     break
 
+                chunks.append(chunk)
+
+            data = b"".join(chunks)
+
             if not data:
                 return
 
-            self.log.debug(f"Poller: read {len(data)} bytes from fd {fd}")
-            self.log.debug(f"Poller: data: '{data}'")
+            # Let the logger format the data, which can be large, only if
+            # debug logging is enabled
+            self.log.debug("Poller: read %d bytes from fd %d", len(data), fd)
+            self.log.debug("Poller: data: %r", data)
 
-            # Call the callback
-            self.callbacks[fd](data.decode(encoding="utf-8", errors="replace"))
+            # Call the callback, the data is decoded when it is accessed
+            self.callbacks[fd](data)
 
         def poll(self, timeout):
+            """Poll for events
+
+            :param timeout: The timeout in milliseconds, if None wait until
+                            an event occurs
+            """
+            if not self.callbacks and not self.exit_callbacks:
+                # No file descriptors are registered, so there is nothing
+                # to wait for. Still honour the timeout, otherwise callers
+                # looping on keep_running() spin while a process without
+                # pipes or pidfd runs.
+                if timeout is not None:
+                    time.sleep(timeout / 1000)
+                return
+
+            if timeout is not None:
+                # epoll takes the timeout in seconds
+                timeout = timeout / 1000
+
             fds = self.poller.poll(timeout)
 
             if len(fds) > 0:
@@ -126,19 +194,28 @@ class ProcessMonitor:
             # First if we have any events, we need to read from the
             # file descriptors
             for fd, event in fds:
-                if event & select.POLLIN:
+                if fd in self.exit_callbacks:
+                    continue
+
+                if event & select.EPOLLIN:
                     self.read_fd(fd)
 
             for fd, event in fds:
-                if event & select.POLLHUP:
+                if fd in self.exit_callbacks:
+                    # The process has exited
+                    callback = self.exit_callbacks[fd]
+                    self.del_pidfd(pidfd=fd)
+                    callback()
+
+                elif event & select.EPOLLHUP:
                     self.del_fd(fd=fd)
 
-                elif event & select.POLLERR:
+                elif event & select.EPOLLERR:
                     self.del_fd(fd=fd)
 
         def wait_fd(self, fd):
             while fd in self.callbacks:
-                self.poll(timeout=0.1)
+                self.poll(timeout=100)
 
     class Process:
         """A process object to track the state of a process"""
@@ -153,14 +230,16 @@ class ProcessMonitor:
 
             self.popen = subprocess.Popen(
                 cmd,
-                stdin=subprocess.PIPE,
+                # We only need stdin to pipe the sudo password
+                stdin=subprocess.PIPE if sudo else subprocess.DEVNULL,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
                 cwd=cwd,
                 env=env,
                 shell=True,
-                # Get stdout and stderr as text
-                text=True,
+                # We read the pipes directly using their file descriptors, so
+                # skip the buffered file objects
+                bufsize=0,
                 # Make sure we can kill the process and the subprocesses
                 # it may create:
                 # https://alexandra-zaharia.github.io/posts/kill-subprocess-and-its-children-on-timeout-python/
@@ -172,7 +251,7 @@ class ProcessMonitor:
                 assert cached_sudo_password.endswith(
                     "\n"
                 )  # Ensure the password ends with a newline as otherwise sudo will hang
-                self.popen.stdin.write(cached_sudo_password)
+                self.popen.stdin.write(cached_sudo_password.encode())
                 self.popen.stdin.flush()
 
             self.info = run_info.RunInfo(
@@ -189,42 +268,55 @@ class ProcessMonitor:
 
             def stdout_callback(data):
 
-                if self.info.stdout is None:
-                    self.info.stdout = data
-                else:
-                    self.info.stdout += data
+                self.info.append_stdout(data)
 
                 if self.info.stdout_callback:
-                    self.info.stdout_callback(data)
+                    self.info.stdout_callback(
+                        data.decode(encoding="utf-8", errors="replace")
+                    )
 
             def stderr_callback(data):
 
-                if self.info.stderr is None:
-                    self.info.stderr = data
-                else:
-                    self.info.stderr += data
+                self.info.append_stderr(data)
 
                 if self.info.stderr_callback:
-                    self.info.stderr_callback(data)
+                    self.info.stderr_callback(
+                        data.decode(encoding="utf-8", errors="replace")
+                    )
 
-            # Get the file descriptor
-            poller.add_fd(
-                self.popen.stdout.fileno(),
-                stdout_callback,
-            )
+            # Whether the exit of the process has been reported
+            self.exit_reported = False
 
-            poller.add_fd(
-                self.popen.stderr.fileno(),
-                stderr_callback,
-            )
+            # Get notified by the poller when an async process exits,
+            # rather than polling for its return code
+            self.pidfd = None
+
+            if is_async:
+                self.pidfd = pidfd_open(self.popen.pid)
+
+            if self.pidfd is not None:
+
+                def exit_callback():
+                    # The process has exited, so this does not block
+                    self.info.returncode = self.popen.wait()
+
+                poller.add_pidfd(self.pidfd, exit_callback)
+
+            # Get the file descriptors
+            stdout_fd = self.popen.stdout.fileno()
+            stderr_fd = self.popen.stderr.fileno()
+
+            poller.add_fd(stdout_fd, stdout_callback)
+            poller.add_fd(stderr_fd, stderr_callback)
 
             if not is_async:
 
                 try:
-                    self.info.returncode = self.popen.wait(timeout=self.info.timeout)
-
-                    poller.wait_fd(self.popen.stdout.fileno())
-                    poller.wait_fd(self.popen.stderr.fileno())
+                    self.info.returncode = self.communicate(
+                        poller=poller,
+                        fds=[stdout_fd, stderr_fd],
+                        timeout=self.info.timeout,
+                    )
 
                     if self.info.returncode != 0:
                         raise errors.RunInfoError(info=self.info)
@@ -238,21 +330,91 @@ class ProcessMonitor:
 
                     self.stop()
 
-                    poller.wait_fd(self.popen.stdout.fileno())
-                    poller.wait_fd(self.popen.stderr.fileno())
+                    poller.wait_fd(stdout_fd)
+                    poller.wait_fd(stderr_fd)
 
                     raise errors.TimeoutError(info=self.info)
 
         def is_running(self):
             """Poll the process and update the return code"""
 
-            if self.info.returncode is not None:
-                return True
-
-            self.info.returncode = self.popen.poll()
+            if self.info.returncode is None and self.pidfd is None:
+                # Without a pidfd we need to poll for the return code
+                self.info.returncode = self.popen.poll()
 
             return self.info.returncode is None
 
+        def communicate(self, poller, fds, timeout=None):
+            """Read the output of the process until it exits.
+
+            The pipes are drained while waiting, otherwise a process writing
+            more than the pipe can hold blocks and never exits.
+
+            :param poller: The poller the file descriptors are added to
+            :param fds: The file descriptors of the process' pipes
+            :param timeout: The timeout in seconds, if None then no timeout
+            :return: The return code of the process
+            :raises subprocess.TimeoutExpired: If the process did not exit
+            """
+
+            if timeout is not None:
+                deadline = time.monotonic() + timeout
+
+            remaining = None
+
+            # The pipes are closed when the process exits
+            while any(fd in poller.callbacks for fd in fds):
+
+                if timeout is not None:
+                    remaining = deadline - time.monotonic()
+
+                    if remaining <= 0:
+                        raise subprocess.TimeoutExpired(
+                            cmd=self.popen.args, timeout=timeout
+                        )
+
+                    # The poller takes the timeout in milliseconds
+                    poller.poll(timeout=remaining * 1000)
+                else:
+                    poller.poll(timeout=None)
+
+            if timeout is not None:
+                remaining = max(0, deadline - time.monotonic())
+
+            return self.wait(timeout=remaining)
+
+        def wait(self, timeout=None):
+            """Wait for the process to exit and return the return code.
+
+            Popen.wait() with a timeout checks the process in a sleep loop,
+            so if possible we block on a pidfd until the process exits.
+
+            :param timeout: The timeout in seconds, if None then no timeout
+            :raises subprocess.TimeoutExpired: If the process did not exit
+            """
+
+            if timeout is None or self.popen.returncode is not None:
+                return self.popen.wait(timeout=timeout)
+
+            pidfd = pidfd_open(self.popen.pid)
+
+            if pidfd is None:
+                return self.popen.wait(timeout=timeout)
+
+            try:
+                poller = select.poll()
+                poller.register(pidfd, select.POLLIN)
+
+                if not poller.poll(timeout * 1000):
+                    raise subprocess.TimeoutExpired(
+                        cmd=self.popen.args, timeout=timeout
+                    )
+            finally:
+                os.close(pidfd)
+
+            # The process has exited, so this does not block
+            return self.popen.wait()
+
         def stop(self):
             """Stop a process"""
 
@@ -261,14 +423,16 @@ class ProcessMonitor:
             if self.info.returncode is not None:
                 return
 
-            # See start_new_sesstion in __init__ for why we use os.killpg
-            os.killpg(os.getpgid(self.popen.pid), signal.SIGTERM)
+            # See start_new_session in __init__ for why we use os.killpg. As
+            # the process is the leader of a new session, its process group
+            # id is the same as its pid.
+            os.killpg(self.popen.pid, signal.SIGTERM)
 
             try:
-                self.info.returncode = self.popen.wait(timeout=0.5)
+                self.info.returncode = self.wait(timeout=0.5)
 
             except subprocess.TimeoutExpired:
-                os.killpg(os.getpgid(self.popen.pid), signal.SIGKILL)
+                os.killpg(self.popen.pid, signal.SIGKILL)
                 self.info.returncode = self.popen.wait()
 
     def __init__(self, log):
@@ -286,6 +450,26 @@ class ProcessMonitor:
         # The poller is used to wait for processes to terminate
         self.poller = ProcessMonitor.Poller(log=log)
 
+        # The time.monotonic() at which processes are stopped, see
+        # set_deadline()
+        self.deadline = None
+
+    def set_deadline(self, seconds):
+        """Stop the processes after a number of seconds.
+
+        Once the deadline has passed, :meth:`keep_running` stops all
+        processes and returns False. The poller wakes up at the deadline,
+        so there is no need to check the time in the loop.
+
+        :param seconds: The number of seconds from now, or None to clear
+            the deadline.
+        """
+
+        if seconds is None:
+            self.deadline = None
+        else:
+            self.deadline = time.monotonic() + seconds
+
     def run_process(self, cmd: str, sudo, cwd=None, env=None, timeout=None):
 
         try:
@@ -343,11 +527,15 @@ class ProcessMonitor:
             # Re-raise the exception to make sure the caller knows
             raise
 
-    def keep_running(self, timeout=0.1):
+    def keep_running(self, timeout=100):
         """Run the process monitor.
 
+        Blocks until a process produces output or exits, or until the
+        timeout expires.
+
         :param timeout: A timeout in milliseconds. If this timeout
-            expires we return.
+            expires we return. The timeout is shortened to not block past
+            the deadline given to :meth:`set_deadline`.
 
         :return: True on timeout and processes are still running. If
             no processes are running anymore return False.
@@ -363,17 +551,38 @@ class ProcessMonitor:
         if not self.processes and self.daemons:
             raise errors.NoProcessesError()
 
+        if not self.processes:
+            # Nothing to wait for
+            self.deadline = None
+            return False
+
+        if self.deadline is not None:
+            remaining = max(0, (self.deadline - time.monotonic()) * 1000)
+
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+
         # Poll for output
         self.poller.poll(timeout)
 
-        self._validate_state()
+        running = self._validate_state()
 
-        # Check if there are any non-daemon processes running
-        for process in self.processes:
-            if process.info.returncode is None:
-                return True
+        if self.deadline is None:
+            return running
+
+        if not running:
+            # The processes finished in time, so the deadline must not
+            # apply to processes started later
+            self.deadline = None
+            return False
+
+        if time.monotonic() >= self.deadline:
+            self.log.debug("Deadline reached, stopping processes")
+            self.deadline = None
+            self.stop()
+            return False
 
-        return False
+        return True
 
     def stop(self):
         """Stop all processes"""
@@ -386,28 +595,58 @@ class ProcessMonitor:
         for daemon in self.daemons:
             daemon.stop()
 
-        # Poll for output
-        self.poller.poll(timeout=0.1)
+        # Poll for the last output of the stopped processes. A pipe may
+        # close a moment after the process exits, so keep polling until
+        # all are closed, for at most 100 ms.
+        deadline = time.monotonic() + 0.1
+
+        while self.poller.callbacks:
+            remaining = deadline - time.monotonic()
+
+            if remaining <= 0:
+                break
+
+            self.poller.poll(timeout=remaining * 1000)
 
         self.processes = []
         self.daemons = []
 
     def _validate_state(self):
+        """Check the state of the processes and daemons.
+
+        :return: True if any non-daemon processes are still running
+        """
 
         # Check if any processes have died with an error
         exceptions = []
 
+        # Check if there are any non-daemon processes running
+        running = False
+
         for process in self.processes:
 
             if process.is_running():
+                running = True
                 continue
 
+            if process.exit_reported:
+                continue
+
+            process.exit_reported = True
+
             if process.info.returncode != 0:
                 exceptions.append(errors.RunInfoError(info=process.info))
 
         for daemon in self.daemons:
-            if not daemon.is_running():
-                exceptions.append(errors.DaemonExitError(info=daemon.info))
+
+            if daemon.is_running() or daemon.exit_reported:
+                continue
+
+            daemon.exit_reported = True
+
+            exceptions.append(errors.DaemonExitError(info=daemon.info))
 
         if exceptions:
             raise ExceptionGroup("Invalid state", exceptions)
+
+        return running
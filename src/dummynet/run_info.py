@@ -1,8 +1,47 @@
 import fnmatch
+import functools
+import re
 
 from . import errors
 
 
+@functools.lru_cache(maxsize=256)
+def _compile_pattern(pattern):
+    """Translate a wildcard pattern to a compiled regular expression"""
+    return re.compile(fnmatch.translate(pattern))
+
+
+class _Output:
+    """The output of a stream, kept as bytes and decoded when accessed"""
+
+    __slots__ = ("data", "text", "lines")
+
+    def __init__(self, text):
+        self.data = None if text is None else bytearray(text.encode("utf-8"))
+        self.text = text
+        self.lines = None
+
+    def append(self, data):
+        if self.data is None:
+            self.data = bytearray()
+
+        self.data += data
+        self.text = None
+        self.lines = None
+
+    def decode(self):
+        if self.text is None and self.data is not None:
+            self.text = self.data.decode(encoding="utf-8", errors="replace")
+
+        return self.text
+
+    def splitlines(self):
+        if self.lines is None and self.data is not None:
+            self.lines = self.decode().splitlines()
+
+        return self.lines
+
+
 class RunInfo:
     """Stores the results from running a command
 
@@ -53,6 +92,38 @@ class RunInfo:
         self.stderr_callback = None
         self.timeout = timeout
 
+    @property
+    def stdout(self):
+        """The standard output stream generated by the command"""
+        return self._stdout.decode()
+
+    @stdout.setter
+    def stdout(self, text):
+        self._stdout = _Output(text)
+
+    @property
+    def stderr(self):
+        """The standard error stream generated by the command"""
+        return self._stderr.decode()
+
+    @stderr.setter
+    def stderr(self, text):
+        self._stderr = _Output(text)
+
+    def append_stdout(self, data):
+        """Append data received on the standard output stream
+
+        :param data: The raw bytes received
+        """
+        self._stdout.append(data)
+
+    def append_stderr(self, data):
+        """Append data received on the standard error stream
+
+        :param data: The raw bytes received
+        """
+        self._stderr.append(data)
+
     def match(self, stdout=None, stderr=None):
         """Matches the lines in the output with the pattern. The match
         pattern can contain basic wildcards, see
@@ -82,10 +153,10 @@ class RunInfo:
         """
 
         if stdout is not None:
-            self._match(stdout, "stdout", self.stdout)
+            self._match(stdout, "stdout", self._stdout)
 
         if stderr is not None:
-            self._match(stderr, "stderr", self.stderr)
+            self._match(stderr, "stderr", self._stderr)
 
     def _match(self, pattern, stream_name, output):
         """Matches the lines in the output with the pattern.
@@ -95,17 +166,23 @@ class RunInfo:
         :param output: The output to match against
         """
 
-        if output is None:
+        lines = output.splitlines()
+
+        if lines is None:
             raise errors.MatchError(
-                pattern=pattern, stream_name=stream_name, output=output
+                pattern=pattern, stream_name=stream_name, output=None
             )
 
-        match_lines = fnmatch.filter(output.splitlines(), pattern)
+        match = _compile_pattern(pattern).match
 
-        if len(match_lines) == 0:
-            raise errors.MatchError(
-                pattern=pattern, stream_name=stream_name, output=output
-            )
+        # Stop at the first line that matches
+        for line in lines:
+            if match(line):
+                return
+
+        raise errors.MatchError(
+            pattern=pattern, stream_name=stream_name, output=output.decode()
+        )
 
     def __str__(self):
         """Print the RunInfo object as a string"""
@@ -0,0 +1,39 @@
+from dummynet import DummyNet
+from dummynet import HostShell
+from dummynet import ProcessMonitor
+
+import logging
+import pytest
+import os
+
+# Check if we need to run as sudo
+SUDO = os.getuid() != 0
+
+
+@pytest.fixture(scope="session")
+def log():
+    log = logging.getLogger("dummynet")
+    log.setLevel(logging.DEBUG)
+
+    return log
+
+
+@pytest.fixture
+def process_monitor(log):
+    return ProcessMonitor(log=log)
+
+
+@pytest.fixture
+def shell(log, process_monitor):
+    return HostShell(log=log, sudo=SUDO, process_monitor=process_monitor)
+
+
+@pytest.fixture
+def net(shell):
+
+    net = DummyNet(shell=shell)
+
+    yield net
+
+    # Clean up, also when the test fails
+    net.cleanup()
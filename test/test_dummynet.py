@@ -1,56 +1,43 @@
-from dummynet import DummyNet
 from dummynet import HostShell
-from dummynet import ProcessMonitor
 
 import dummynet
 
-import logging
 import time
+import shutil
 import pytest
-import os
 
+# Many of the tests use ping to generate traffic and output
+requires_ping = pytest.mark.skipif(
+    shutil.which("ping") is None, reason="ping is not installed"
+)
 
-log = logging.getLogger("dummynet")
-log.setLevel(logging.DEBUG)
 
-
-def test_run():
-
-    # Check if we need to run as sudo
-    sudo = os.getuid() != 0
-
-    # Create a process monitor
-    process_monitor = ProcessMonitor(log=log)
-
-    # The host shell used if we don't have a recording
-    shell = HostShell(log=log, sudo=sudo, process_monitor=process_monitor)
+@requires_ping
+def test_run(net):
 
     # Create a mock shell which will receive the calls performed by the DummyNet
     # shell = mockshell.MockShell()
     # shell.open(recording="test/data/calls.json", shell=host_shell)
 
-    # DummyNet wrapper that will prevent clean up from happening in playback
-    # mode if an exception occurs
-    net = DummyNet(shell=shell)
-
-    try:
-        # Get a list of the current namespaces
-        namespaces = net.netns_list()
-        assert namespaces == []
-
-        # create two namespaces
-        demo0 = net.netns_add(name="demo0")
-        demo1 = net.netns_add(name="demo1")
-        demo2 = net.netns_add(name="demo2")
+    # Get a list of the current namespaces
+    namespaces = net.netns_list()
+    assert namespaces == []
 
-        # Get a list of the current namespaces
-        namespaces = net.netns_list()
+    # create two namespaces
+    demo0 = net.netns_add(name="demo0")
+    demo1 = net.netns_add(name="demo1")
+    demo2 = net.netns_add(name="demo2")
 
-        assert namespaces == sorted(["demo2", "demo1", "demo0"])
+    # Get a list of the current namespaces
+    namespaces = net.netns_list()
 
-        # Add a bridge in demo1
-        demo1.bridge_add(name="br0")
+    assert set(namespaces) == {"demo0", "demo1", "demo2"}
 
+    # Configure the links in a batch. Only consecutive commands for the same
+    # namespace and tool run together, so they are grouped by namespace:
+    # one 'ip -batch' for the host and each namespace, and a 'tc -batch'
+    # for demo1.
+    with net.batch():
         net.link_veth_add(p1_name="demo0-eth0", p2_name="demo1-eth0")
         net.link_veth_add(p1_name="demo1-eth1", p2_name="demo2-eth0")
 
@@ -60,144 +47,260 @@ def test_run():
         net.link_set(namespace="demo1", interface="demo1-eth1")
         net.link_set(namespace="demo2", interface="demo2-eth0")
 
-        demo1.bridge_set(name="br0", interface="demo1-eth0")
-        demo1.bridge_set(name="br0", interface="demo1-eth1")
-
-        # Bind an IP-address to the two peers in the link.
+        # Bind an IP-address to the first peer and activate the interface.
         demo0.addr_add(ip="10.0.0.1/24", interface="demo0-eth0")
-        demo2.addr_add(ip="10.0.0.2/24", interface="demo2-eth0")
-
-        # Activate the interfaces.
         demo0.up(interface="demo0-eth0")
+
+        # Add a bridge in demo1 and activate the interfaces.
+        demo1.bridge_add(name="br0")
+        demo1.bridge_set(name="br0", interface="demo1-eth0")
+        demo1.bridge_set(name="br0", interface="demo1-eth1")
         demo1.up(interface="br0")
         demo1.up(interface="demo1-eth0")
         demo1.up(interface="demo1-eth1")
-        demo2.up(interface="demo2-eth0")
 
         # We will add 20 ms of delay, 1% packet loss, a queue limit of 100 packets
         # and 10 Mbit/s of bandwidth max.
         demo1.tc(interface="demo1-eth0", delay=20, loss=1, limit=100, rate=10)
         demo1.tc(interface="demo1-eth1", delay=20, loss=1, limit=100, rate=10)
 
-        # Show the tc-configuration of the interfaces.
-        demo1.tc_show(interface="demo1-eth0")
-        demo1.tc_show(interface="demo1-eth0")
+        # Bind an IP-address to the second peer and activate the interface.
+        demo2.addr_add(ip="10.0.0.2/24", interface="demo2-eth0")
+        demo2.up(interface="demo2-eth0")
 
-        out = demo0.run(cmd="ping -c 10 10.0.0.2")
-        out.match(stdout="10 packets transmitted*", stderr=None)
+    # Show the tc-configuration of the interfaces.
+    demo1.tc_show(interface="demo1-eth0")
 
-    finally:
-        # Clean up.
-        net.cleanup()
+    out = demo0.run(cmd="ping -i 0.2 -c 10 10.0.0.2")
+    out.match(stdout="10 packets transmitted*", stderr=None)
 
 
-def test_run_async():
+@requires_ping
+def test_run_async(net, process_monitor):
 
-    # Check if we need to run as sudo
-    sudo = os.getuid() != 0
+    # Get a list of the current namespaces
+    namespaces = net.netns_list()
+    assert namespaces == []
 
-    process_monitor = ProcessMonitor(log=log)
+    # create two namespaces
+    demo0 = net.netns_add(name="demo0")
+    demo1 = net.netns_add(name="demo1")
 
-    shell = HostShell(log=log, sudo=sudo, process_monitor=process_monitor)
+    # Configure the link in a batch. Only consecutive commands for the same
+    # namespace run together, so they are grouped: one 'ip -batch' for the
+    # host and one for each namespace.
+    with net.batch():
+        net.link_veth_add(p1_name="demo0-eth0", p2_name="demo1-eth0")
 
-    net = DummyNet(shell=shell)
+        # Move the interfaces to the namespaces
+        net.link_set(namespace="demo0", interface="demo0-eth0")
+        net.link_set(namespace="demo1", interface="demo1-eth0")
 
-    try:
-        # Get a list of the current namespaces
-        namespaces = net.netns_list()
-        assert namespaces == []
+        # Bind an IP-address to the two peers in the link and activate the
+        # interfaces.
+        demo0.addr_add(ip="10.0.0.1/24", interface="demo0-eth0")
+        demo0.up(interface="demo0-eth0")
+        demo0.up(interface="lo")
 
-        # create two namespaces
+        demo1.addr_add(ip="10.0.0.2/24", interface="demo1-eth0")
+        demo1.up(interface="demo1-eth0")
+        demo1.up(interface="lo")
+
+    proc0 = demo0.run_async(cmd="ping -i 0.2 -c 10 10.0.0.2")
+    proc1 = demo1.run_async(cmd="ping -i 0.2 -c 10 10.0.0.1")
+
+    def _proc0_stdout(data):
+        print("proc0: {}".format(data))
+
+    def _proc1_stdout(data):
+        print("proc1: {}".format(data))
+
+    proc0.stdout_callback = _proc0_stdout
+    proc1.stdout_callback = _proc1_stdout
+
+    while process_monitor.keep_running():
+        pass
+
+    proc0.match(stdout="10 packets transmitted*", stderr=None)
+    proc1.match(stdout="10 packets transmitted*", stderr=None)
+
+
+def test_batch(net):
+
+    with net.batch():
         demo0 = net.netns_add(name="demo0")
         demo1 = net.netns_add(name="demo1")
 
-        net.link_veth_add(p1_name="demo0-eth0", p2_name="demo1-eth0")
-
-        # Move the interfaces to the namespaces
+        net.link_veth_add("demo0-eth0", "demo1-eth0")
         net.link_set(namespace="demo0", interface="demo0-eth0")
         net.link_set(namespace="demo1", interface="demo1-eth0")
 
-        # Bind an IP-address to the two peers in the link.
         demo0.addr_add(ip="10.0.0.1/24", interface="demo0-eth0")
         demo1.addr_add(ip="10.0.0.2/24", interface="demo1-eth0")
 
-        # Activate the interfaces.
         demo0.up(interface="demo0-eth0")
         demo1.up(interface="demo1-eth0")
+
+    out = demo0.run(cmd="ip addr show dev demo0-eth0")
+    out.match(stdout="*inet 10.0.0.1/24*", stderr=None)
+
+    out = demo1.run(cmd="ip link show dev demo1-eth0")
+    out.match(stdout="*state UP*", stderr=None)
+
+
+def test_batch_order(net):
+
+    demo0 = net.netns_add(name="demo0")
+
+    # The commands alternate between the host and the namespace, and each
+    # depends on the one before it
+    with net.batch():
+        demo0.bridge_add(name="br0")
+        net.link_veth_add(p1_name="demo0-eth0", p2_name="host-eth0")
+        net.link_set(namespace="demo0", interface="demo0-eth0")
+        demo0.bridge_set(name="br0", interface="demo0-eth0")
+        demo0.up(interface="br0")
+
+    out = demo0.run(cmd="ip link show dev demo0-eth0")
+    out.match(stdout="*master br0*", stderr=None)
+
+    out = demo0.run(cmd="ip link show dev br0")
+    out.match(stdout="*UP*", stderr=None)
+
+
+def test_batch_discard(net):
+
+    demo0 = net.netns_add(name="demo0")
+
+    with pytest.raises(RuntimeError):
+        with net.batch():
+            demo0.bridge_add(name="br0")
+            raise RuntimeError("Configuration failed")
+
+    # The queued command was dropped, and is not run by a later batch
+    with net.batch():
         demo0.up(interface="lo")
-        demo1.up(interface="lo")
 
-        proc0 = demo0.run_async(cmd="ping -c 10 10.0.0.2")
-        proc1 = demo1.run_async(cmd="ping -c 10 10.0.0.1")
+    assert demo0.bridge_list() == []
 
-        def _proc0_stdout(data):
-            print("proc0: {}".format(data))
 
-        def _proc1_stdout(data):
-            print("proc1: {}".format(data))
+def test_batch_nested(shell, net):
 
-        proc0.stdout_callback = _proc0_stdout
-        proc1.stdout_callback = _proc1_stdout
+    demo0 = net.netns_add(name="demo0")
 
-        while process_monitor.keep_running():
-            pass
+    with net.batch():
+        with net.batch():
+            demo0.bridge_add(name="br0")
 
-        proc0.match(stdout="10 packets transmitted*", stderr=None)
-        proc1.match(stdout="10 packets transmitted*", stderr=None)
+        # The inner batch leaves running the commands to the outer one. We
+        # check using the shell directly, as DummyNet would run them first.
+        out = shell.run(cmd="ip netns exec demo0 ip -json link list type bridge")
+        assert out.stdout.strip() in ("", "[]")
 
-    finally:
-        # Clean up.
-        net.cleanup()
+    assert demo0.bridge_list() == ["br0"]
 
 
-def test_with_timeout():
+def test_batch_flush(net):
 
-    # Check if we need to run as sudo
-    sudo = os.getuid() != 0
+    demo0 = net.netns_add(name="demo0")
 
-    # Create a process monitor
-    process_monitor = ProcessMonitor(log=log)
+    with net.batch():
+        demo0.bridge_add(name="br0")
 
-    # The host shell used if we don't have a recording
-    shell = HostShell(log=log, sudo=sudo, process_monitor=process_monitor)
+        # Commands with output run the queued commands first
+        assert demo0.bridge_list() == ["br0"]
 
-    # DummyNet wrapper that will prevent clean up from happening in playback
-    # mode if an exception occurs
-    net = DummyNet(shell=shell)
+        demo0.up(interface="br0")
 
-    try:
-        # Run a command on the host
-        out = net.run(cmd="ping -c 5 8.8.8.8")
-        out.match(stdout="5 packets transmitted*", stderr=None)
+        out = demo0.run(cmd="ip link show dev br0")
+        out.match(stdout="*UP*", stderr=None)
 
-        out = net.run_async(cmd="ping -c 5000 8.8.8.8")
 
-        end_time = time.time() + 2
+def test_link_list(net):
 
-        while process_monitor.keep_running(timeout=0.5):
-            if time.time() >= end_time:
-                log.debug("Test timeout")
-                process_monitor.stop()
+    demo0 = net.netns_add(name="demo0")
 
-    finally:
-        # Clean up.
-        net.cleanup()
+    demo0.link_veth_add(p1_name="demo0-eth0", p2_name="demo0-eth1")
+    demo0.bridge_add(name="br0")
+    demo0.bridge_set(name="br0", interface="demo0-eth0")
 
+    assert demo0.link_list(link_type="veth") == ["demo0-eth0", "demo0-eth1"]
+    assert demo0.bridge_list() == ["br0"]
+    assert set(demo0.link_list()) == {"lo", "br0", "demo0-eth0", "demo0-eth1"}
 
-def test_daemon_exit():
 
-    # Check if we need to run as sudo
-    sudo = os.getuid() != 0
+@requires_ping
+def test_with_timeout(net, process_monitor):
 
-    # Create a process monitor
-    process_monitor = ProcessMonitor(log=log)
+    # Run a command on the host
+    out = net.run(cmd="ping -i 0.2 -c 5 8.8.8.8")
+    out.match(stdout="5 packets transmitted*", stderr=None)
 
-    # The host shell used if we don't have a recording
-    shell = HostShell(log=log, sudo=sudo, process_monitor=process_monitor)
+    out = net.run_async(cmd="ping -c 5000 8.8.8.8")
+
+    # Stop the processes after 2 seconds
+    process_monitor.set_deadline(2)
+
+    while process_monitor.keep_running():
+        pass
+
+
+def test_deadline(shell, process_monitor):
+
+    out = shell.run_async(cmd="sleep 10")
+
+    # Stop the process after 0.2 seconds
+    process_monitor.set_deadline(0.2)
+
+    start = time.monotonic()
+
+    while process_monitor.keep_running():
+        pass
+
+    assert time.monotonic() - start < 0.7
+
+    # The process was stopped
+    assert out.returncode is not None
+    assert out.returncode != 0
+
+    # The deadline does not apply to the next run
+    out = shell.run_async(cmd="sleep 0.1; echo done")
+
+    while process_monitor.keep_running():
+        pass
+
+    assert out.returncode == 0
+    assert out.stdout == "done\n"
+
+
+def test_deadline_not_reached(shell, process_monitor):
+
+    # The processes finish before the deadline
+    shell.run_async(cmd="sleep 0.1")
+    process_monitor.set_deadline(0.2)
+
+    while process_monitor.keep_running():
+        pass
+
+    # Wait until the deadline would have passed
+    time.sleep(0.3)
+
+    # The deadline must not stop processes started afterwards
+    out = shell.run_async(cmd="sleep 0.1; echo done")
+
+    while process_monitor.keep_running():
+        pass
+
+    assert out.returncode == 0
+    assert out.stdout == "done\n"
+
+
+@requires_ping
+def test_daemon_exit(shell, process_monitor):
 
     # Run two commands on the host where the daemon will exit
     # before the non-daemon command
-    shell.run_async(cmd="ping -c 5 8.8.8.8", daemon=True)
+    shell.run_async(cmd="ping -i 0.2 -c 5 8.8.8.8", daemon=True)
     shell.run_async(cmd="ping -c 50 8.8.8.8")
 
     with pytest.raises(ExceptionGroup) as e:
@@ -207,16 +310,8 @@ def test_daemon_exit():
     assert e.group_contains(dummynet.DaemonExitError)
 
 
-def test_all_daemons():
-
-    # Check if we need to run as sudo
-    sudo = os.getuid() != 0
-
-    # Create a process monitor
-    process_monitor = ProcessMonitor(log=log)
-
-    # The host shell used if we don't have a recording
-    shell = HostShell(log=log, sudo=sudo, process_monitor=process_monitor)
+@requires_ping
+def test_all_daemons(shell, process_monitor):
 
     # Run two commands where both are daemons
     shell.run_async(cmd="ping -c 5 8.8.8.8", daemon=True)
@@ -227,20 +322,14 @@ def test_all_daemons():
             pass
 
 
-def test_no_processes():
-
-    # Create a process monitor
-    process_monitor = ProcessMonitor(log=log)
+def test_no_processes(process_monitor):
 
     # Nothing to do
     while process_monitor.keep_running():
         pass
 
 
-def test_hostshell_timeout():
-
-    # Create a process monitor
-    process_monitor = ProcessMonitor(log=log)
+def test_hostshell_timeout(log, process_monitor):
 
     # The host shell
     shell = HostShell(log=log, sudo=False, process_monitor=process_monitor)
@@ -264,19 +353,10 @@ def test_hostshell_timeout():
         pass
 
 
-def _hostshell_timeout_daemon():
+def _hostshell_timeout_daemon(shell, process_monitor):
     # Seperated this in to a function to look like a typical integration
     # test
 
-    # Check if we need to run as sudo
-    sudo = os.getuid() != 0
-
-    # Create a process monitor
-    process_monitor = ProcessMonitor(log=log)
-
-    # The host shell
-    shell = HostShell(log=log, sudo=sudo, process_monitor=process_monitor)
-
     # Start a deamon process (those should not exit before the test is over)
     shell.run_async(cmd="sleep 2", daemon=True)
 
@@ -291,21 +371,18 @@ def _hostshell_timeout_daemon():
         pass
 
 
-def test_hostshell_timeout_daemon():
+def test_hostshell_timeout_daemon(shell, process_monitor):
 
     # Check that we get a timeout if we run a command that takes too long
 
     with pytest.raises(ExceptionGroup) as e:
-        _hostshell_timeout_daemon()
+        _hostshell_timeout_daemon(shell=shell, process_monitor=process_monitor)
 
     assert e.group_contains(dummynet.TimeoutError)
     assert e.group_contains(dummynet.DaemonExitError)
 
 
-def test_run_stdout():
-
-    # Create a process monitor
-    process_monitor = ProcessMonitor(log=log)
+def test_run_stdout(log, process_monitor, tmp_path):
 
     # The host shell used if we don't have a recording
     shell = HostShell(log=log, sudo=False, process_monitor=process_monitor)
@@ -315,28 +392,37 @@ def test_run_stdout():
     assert len(info.stdout) == len(message) + 1
     assert info.stdout == f"{message}\n"
 
-    long_message = "A" * 4096
+    # The longer messages are read from a file, rather than passed on the
+    # command line
+    long_message = tmp_path / "long_message"
+    long_message.write_text("A" * 4096 + "\n")
 
-    info = shell.run(cmd=f"echo '{long_message}'")
+    info = shell.run(cmd=f"cat {long_message}")
 
     assert len(info.stdout) == 4096 + 1
-    assert info.stdout == f"{long_message}\n"
+    assert info.stdout == long_message.read_text()
 
-    very_long_message = "A" * 4096 * 10
+    very_long_message = tmp_path / "very_long_message"
+    very_long_message.write_text("A" * 4096 * 10 + "\n")
 
-    info = shell.run(cmd=f"echo '{very_long_message}'")
+    info = shell.run(cmd=f"cat {very_long_message}")
 
     assert len(info.stdout) == 4096 * 10 + 1
-    assert info.stdout == f"{very_long_message}\n"
+    assert info.stdout == very_long_message.read_text()
+
+    # More output than a pipe can hold (64 KiB), which must be read while
+    # the process runs for it to exit
+    info = shell.run(cmd="head -c 1000000 /dev/zero", timeout=10)
+
+    assert len(info.stdout) == 1000000
 
     # check timeout of function with a long message
     with pytest.raises(dummynet.TimeoutError):
-        shell.run(cmd=f"sleep 10; echo '{very_long_message}'", timeout=1)
-
+        shell.run(cmd=f"sleep 10; cat {very_long_message}", timeout=1)
 
-def test_run_async_output():
 
-    process_monitor = ProcessMonitor(log=log)
+@requires_ping
+def test_run_async_output(log, process_monitor):
 
     shell = HostShell(log=log, sudo=False, process_monitor=process_monitor)
 
@@ -353,6 +439,35 @@ def test_run_async_output():
     out2.match(stdout="3 packets transmitted*", stderr=None)
 
 
+def test_run_info_output():
+
+    info = dummynet.RunInfo(
+        cmd="echo",
+        cwd=None,
+        pid=0,
+        stdout="",
+        stderr=None,
+        returncode=None,
+        is_async=True,
+        is_daemon=False,
+        timeout=None,
+    )
+
+    assert info.stdout == ""
+    assert info.stderr is None
+
+    # A multi-byte character split across two reads
+    data = "Hello Wørld\n".encode("utf-8")
+    info.append_stdout(data[:7])
+    info.append_stdout(data[7:])
+
+    assert info.stdout == "Hello Wørld\n"
+    info.match(stdout="Hello W?rld")
+
+    info.append_stderr(b"error\n")
+    assert info.stderr == "error\n"
+
+
 # @todo re-enable this test
 # @pytest.fixture
 # def sad_path():